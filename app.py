@@ -1,135 +1,446 @@
 import streamlit as st
-from ollama import chat
-import subprocess, json, os, time, uuid
+import streamlit.components.v1 as components
+from ollama import AsyncClient, ResponseError
+import httpx
+import asyncio, atexit, hashlib, io, json, pickle, queue, shutil, sqlite3, tempfile, threading, time, traceback, uuid, weakref
 from datetime import datetime
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
 
-# Dependencies: pip install PyPDF2 docx2txt
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Dependencies: pip install PyPDF2 docx2txt (optional: orjson, pymupdf for faster PDFs)
 
 # ─── Constants & Helpers ──────────────────────────────────────────────────────
-HISTORY_DIR = "chat_histories"
+HISTORY_DB = "history.db"
 SYSTEM_PROMPT_KEY = "system_prompt"
 USER_ID_KEY = "user_id"
+STREAM_FLUSH_INTERVAL = 0.025  # Seconds of deltas to buffer per st.write_stream update
+MODEL_KEEP_ALIVE = "30m"  # How long Ollama keeps the selected model loaded after each request
+MAX_CONTEXT_MSGS = 20  # Default number of recent messages sent with each request
+HISTORY_PAGE_SIZE = 50  # Chats listed in the sidebar before "Show older chats"
+MESSAGE_PAGE_SIZE = 100  # Messages shown in the chat before "Show earlier messages"
+MAX_FILE_CONTEXT_CHARS = 128_000  # Roughly 32k tokens of file context per message
+
+# Auto-scroll while a reply streams in, driven by DOM changes instead of a timer
+SCROLL_JS = """
+<script>
+const doc = window.parent.document;
+function scrollToBottom() {
+    const chatContainer = doc.querySelector('.chat-container');
+    if (chatContainer) {
+        chatContainer.scrollTop = chatContainer.scrollHeight;
+    } else {
+        doc.body.scrollTop = doc.body.scrollHeight;
+        doc.documentElement.scrollTop = doc.documentElement.scrollHeight;
+    }
+}
+// Replace any observer left behind by a previous instance of this frame
+if (window.parent.chatScrollObserver) {
+    window.parent.chatScrollObserver.disconnect();
+}
+const observer = new MutationObserver(scrollToBottom);
+window.parent.chatScrollObserver = observer;
+observer.observe(
+    doc.querySelector('section.main') || doc.body,
+    {childList: true, subtree: true, characterData: true}
+);
+// Stop following once Streamlit removes this frame after the reply
+window.addEventListener('pagehide', () => observer.disconnect());
+scrollToBottom();
+</script>
+"""
+
+CHATS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        user_id TEXT,
+        chat_id TEXT,
+        chat_idx INT,  -- Creation order, only used for sorting
+        name TEXT,
+        timestamp TEXT,
+        model TEXT,
+        messages BLOB,
+        PRIMARY KEY (user_id, chat_id)
+    )
+"""
 
-# Create history directory
-Path(HISTORY_DIR).mkdir(exist_ok=True)
+def _connect_history_db():
+    conn = sqlite3.connect(HISTORY_DB, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
 
-def get_user_history_file():
-    """Get history file path for current user"""
-    if USER_ID_KEY not in st.session_state:
-        st.session_state[USER_ID_KEY] = str(uuid.uuid4())
-    return os.path.join(HISTORY_DIR, f"{st.session_state[USER_ID_KEY]}.json")
+@st.cache_resource(show_spinner=False)
+def get_history_db():
+    """Open the chat history database shared by all sessions"""
+    conn = _connect_history_db()
+    conn.execute(CHATS_TABLE_SQL.format(table="chats"))
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(chats)")}
+    if "messages_json" in columns:
+        conn.execute("ALTER TABLE chats RENAME COLUMN messages_json TO messages")
+    if "chat_id" not in columns:
+        # Rows keyed by list position: give each an id so deletes never renumber
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute(CHATS_TABLE_SQL.format(table="chats_by_id"))
+            conn.execute("""
+                INSERT INTO chats_by_id
+                SELECT user_id, lower(hex(randomblob(16))), chat_idx, name, timestamp, model, messages
+                FROM chats
+            """)
+            conn.execute("DROP TABLE chats")
+            conn.execute("ALTER TABLE chats_by_id RENAME TO chats")
+    return conn
+
+def _encode_messages(messages):
+    # History is only ever read back by this app, so pickle beats JSON encoding
+    return pickle.dumps(messages, protocol=5)
+
+def _decode_messages(blob):
+    if isinstance(blob, bytes) and blob[:1] == b"\x80":
+        return pickle.loads(blob)
+    # Rows saved before the switch to pickle
+    return orjson.loads(blob) if orjson else json.loads(blob)
 
 def load_history():
-    history_file = get_user_history_file()
-    if os.path.exists(history_file):
+    # Metadata only; each chat's messages are read when it is opened
+    rows = get_history_db().execute(
+        "SELECT chat_id, name, timestamp, model FROM chats WHERE user_id = ? ORDER BY chat_idx",
+        (st.session_state[USER_ID_KEY],)
+    )
+    # Keyed by chat id; dicts keep insertion order, i.e. oldest chat first
+    return {
+        chat_id: {"name": name, "timestamp": timestamp, "model": model}
+        for chat_id, name, timestamp, model in rows
+    }
+
+def chat_messages(chat_id):
+    """Load a stored chat's messages the first time they are needed"""
+    chat_obj = st.session_state.chat_history[chat_id]
+    if "messages" not in chat_obj:
+        # Not yet saved in this session, so the stored row is up to date
+        row = get_history_db().execute(
+            "SELECT messages FROM chats WHERE user_id = ? AND chat_id = ?",
+            (st.session_state[USER_ID_KEY], chat_id)
+        ).fetchone()
+        chat_obj["messages"] = _decode_messages(row[0]) if row else []
+    return chat_obj["messages"]
+
+def _chat_row(user_id, chat_id, chat_obj):
+    return (
+        user_id, chat_id, user_id, chat_obj.get("name"), chat_obj.get("timestamp"), chat_obj.get("model"),
+        _encode_messages(chat_obj["messages"])
+    )
+
+def _apply_history_writes(conn, batch):
+    with conn:
+        conn.execute("BEGIN")
+        for statements in batch:
+            for sql, params in statements:
+                conn.execute(sql, params)
+
+def _drain_history_writes(conn, writes):
+    while True:
+        # Apply everything queued so far in one transaction, i.e. one commit
+        batch = [writes.get()]
+        while not writes.empty():
+            batch.append(writes.get_nowait())
         try:
-            with open(history_file, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
-            return []
-    return []
+            _apply_history_writes(conn, batch)
+        except sqlite3.Error:
+            # The whole batch was rolled back; retry each write on its own so
+            # one bad or locked write cannot discard other chats' saves
+            for statements in batch:
+                try:
+                    _apply_history_writes(conn, [statements])
+                except sqlite3.Error:
+                    traceback.print_exc()
+        finally:
+            for _ in batch:
+                writes.task_done()
+
+@st.cache_resource(show_spinner=False)
+def get_history_writer():
+    """Start the background thread that applies history writes in order"""
+    get_history_db()  # Make sure the schema exists before writing
+    writes = queue.Queue()
+    threading.Thread(
+        target=_drain_history_writes, args=(_connect_history_db(), writes),
+        name="history-writer", daemon=True
+    ).start()
+    atexit.register(writes.join)  # Flush pending writes before the process exits
+    return writes
 
-def save_history(h):
-    with open(get_user_history_file(), "w", encoding="utf-8") as f:
-        json.dump(h, f, indent=2, ensure_ascii=False)
+def _queue_history_write(*statements):
+    get_history_writer().put(statements)
 
+def save_chat(chat_obj, chat_id):
+    """Queue an insert or update of a single chat row"""
+    # Encode now so the writer never reads a message list the session is changing
+    _queue_history_write((
+        """
+        INSERT INTO chats VALUES (
+            ?, ?, (SELECT COALESCE(MAX(chat_idx) + 1, 0) FROM chats WHERE user_id = ?), ?, ?, ?, ?
+        )
+        ON CONFLICT (user_id, chat_id) DO UPDATE SET
+            name = excluded.name, timestamp = excluded.timestamp,
+            model = excluded.model, messages = excluded.messages
+        """,
+        _chat_row(st.session_state[USER_ID_KEY], chat_id, chat_obj)
+    ))
+
+def delete_chat(chat_id):
+    """Queue deleting a single chat row"""
+    _queue_history_write((
+        "DELETE FROM chats WHERE user_id = ? AND chat_id = ?",
+        (st.session_state[USER_ID_KEY], chat_id)
+    ))
+
+def clear_history():
+    """Queue deleting all of the current user's chat rows"""
+    _queue_history_write(("DELETE FROM chats WHERE user_id = ?", (st.session_state[USER_ID_KEY],)))
+
+@st.cache_resource
+def get_ollama_runtime():
+    """Start one background event loop and AsyncClient shared by all sessions"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="ollama-client", daemon=True).start()
+    return loop, AsyncClient()
+
+@st.cache_data(ttl=60, show_spinner=False)
 def get_ollama_models():
+    loop, client = get_ollama_runtime()
+    try:
+        # One /api/tags request to the running server instead of spawning the CLI
+        response = asyncio.run_coroutine_threadsafe(client.list(), loop).result()
+        models = [m["model"] for m in response["models"]]
+    except (ResponseError, httpx.HTTPError, ConnectionError):
+        models = []
+    return models or ["llama3", "mistral"]  # Fallback models
+
+def warm_model(model):
+    """Start loading a model into Ollama's memory without waiting for it"""
+    loop, client = get_ollama_runtime()
+    # A generate request with no prompt only loads the model; failures (e.g. an
+    # unknown model) surface on the first chat request instead
+    asyncio.run_coroutine_threadsafe(client.generate(model=model, keep_alive=MODEL_KEEP_ALIVE), loop)
+
+async def _pump_chat(stream, deltas):
+    try:
+        async for chunk in stream:
+            deltas.put(chunk.get("message", {}).get("content", ""))
+    finally:
+        deltas.put(None)
+
+def stream_chat(model, messages, idle_interval=STREAM_FLUSH_INTERVAL):
+    """Yield reply deltas from the shared AsyncClient, and "" after each idle_interval without one"""
+    loop, client = get_ollama_runtime()
+    stream = asyncio.run_coroutine_threadsafe(
+        client.chat(model=model, messages=messages, stream=True, keep_alive=MODEL_KEEP_ALIVE), loop
+    ).result()
+    # The event loop reads the stream into a queue, so this thread can wait with a timeout
+    deltas = queue.Queue()
+    pump = asyncio.run_coroutine_threadsafe(_pump_chat(stream, deltas), loop)
+    try:
+        while True:
+            try:
+                delta = deltas.get(timeout=idle_interval)
+            except queue.Empty:
+                # Lets consumers flush what they buffered during a pause between tokens
+                yield ""
+                continue
+            if delta is None:
+                pump.result()  # Re-raise whatever ended the stream early
+                return
+            yield delta
+    finally:
+        pump.cancel()  # A stop closes the request instead of reading the rest
+
+def coalesce_deltas(deltas, interval=STREAM_FLUSH_INTERVAL):
+    """Buffer deltas in a list and yield them joined at most once per interval"""
+    # st.write_stream re-concatenates and redraws the whole reply per item it
+    # receives, so handing it batches keeps that work off the per-token path.
+    # Empty deltas only trigger the time check, so a pause still flushes the tail
+    pending = []
+    last_flush = time.monotonic()
+    for delta in deltas:
+        if delta:
+            pending.append(delta)
+        now = time.monotonic()
+        if pending and now - last_flush >= interval:
+            yield "".join(pending)
+            pending.clear()
+            last_flush = now
+    # Not reached when a stop closes this generator mid-stream; the unsent tail
+    # is then dropped here, so callers record deltas before they are buffered
+    if pending:
+        yield "".join(pending)
+
+@st.cache_resource
+def get_file_context_dir():
+    """Create this server's private upload directory, removed again on exit"""
+    path = tempfile.mkdtemp(prefix="ollama_chat_uploads_")  # Only readable by its owner
+    atexit.register(shutil.rmtree, path, ignore_errors=True)
+    return Path(path)
+
+class FileContext:
+    """Extracted upload text kept in a private temp file instead of session state"""
+    def __init__(self, content, chars):
+        fd, self.path = tempfile.mkstemp(suffix=".txt", dir=get_file_context_dir())
+        with open(fd, "wb") as f:
+            # PDF/DOCX extraction can return lone surrogates, which strict UTF-8 rejects
+            f.write(content if isinstance(content, bytes) else content.encode("utf-8", errors="replace"))
+        self.chars = chars
+        # Call to remove the file; also runs once the session is gone and this is collected
+        self.delete = weakref.finalize(self, Path(self.path).unlink, missing_ok=True)
+
+def context_window(messages, limit):
+    """Return the recent messages to send, dropping the oldest in blocks of half the limit"""
+    # Trimming one message per turn would change the prompt right after the system
+    # prompt every time; whole blocks keep it stable for several turns, so Ollama's
+    # prompt cache can reuse the processed prefix
+    excess = len(messages) - limit
+    if excess <= 0:
+        return messages
+    step = max(limit // 2, 1)
+    return messages[-(-excess // step) * step:]
+
+def iter_file_context(path, limit, block_size=65536):
+    """Yield stored file text in blocks, stopping after limit characters"""
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        while limit > 0:
+            block = f.read(min(block_size, limit))
+            if not block:
+                break
+            limit -= len(block)
+            yield block
+
+# Every UTF-8 byte that is not a continuation byte starts a new character
+UTF8_CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+
+def utf8_char_count(data):
+    """Count the characters in UTF-8 bytes without decoding them"""
+    return len(data.translate(None, UTF8_CONTINUATION_BYTES))
+
+def truncate_preview(text, limit):
+    """Shorten text for display, marking the cut with an ellipsis"""
+    return text[:limit] + ("..." if len(text) > limit else "")
+
+class MissingDependencyError(Exception):
+    """Raised when an optional file-parsing library is not installed"""
+
+@lru_cache(maxsize=1)
+def _pypdf():
+    try:
+        import PyPDF2
+    except ImportError:
+        raise MissingDependencyError("PyPDF2 required for PDF processing. Install with `pip install PyPDF2`")
+    return PyPDF2
+
+@lru_cache(maxsize=1)
+def _pymupdf():
+    """Optional faster PDF backend; None when not installed"""
     try:
-        result = subprocess.run(["ollama", "list"], capture_output=True, text=True, check=True)
-        return [line.split()[0] for line in result.stdout.splitlines()[1:] if line.strip()]
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        return ["llama3", "mistral"]  # Fallback models
-
-def render_markdown_with_code(text):
-    """Render text with proper code block formatting"""
-    in_code_block = False
-    code_lines = []
-    output = []
+        import pymupdf
+    except ImportError:
+        return None
+    return pymupdf
+
+@lru_cache(maxsize=1)
+def _docx2txt():
+    try:
+        import docx2txt
+    except ImportError:
+        raise MissingDependencyError("docx2txt required for DOCX processing. Install with `pip install docx2txt`")
+    return docx2txt
+
+def _file_kind(file_type):
+    if file_type.startswith('text/') or file_type in ['application/json', 'application/xml']:
+        return "text"
+    if file_type == 'application/pdf':
+        return "pdf"
+    if file_type in ['application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+                     'application/msword']:
+        return "docx"
+    return None
+
+def _extract_pdf_text(data):
+    pymupdf = _pymupdf()
+    if pymupdf is not None:
+        with pymupdf.open(stream=data, filetype="pdf") as doc:
+            return "\n".join(page.get_text() for page in doc)
     
-    for line in text.split('\n'):
-        if line.startswith('```'):
-            if in_code_block:
-                # End of code block
-                code = '\n'.join(code_lines)
-                language = code_lines[0].strip() if code_lines and code_lines[0] else ''
-                if language and ' ' not in language:
-                    code = '\n'.join(code_lines[1:])
-                else:
-                    language = ''
-                output.append(f'```{language}\n{code}\n```')
-                code_lines = []
-                in_code_block = False
-            else:
-                # Start of code block
-                in_code_block = True
-                language = line[3:].strip()
-                if language:
-                    code_lines.append(language)
-        elif in_code_block:
-            code_lines.append(line)
-        else:
-            output.append(line)
-            
-    return '\n'.join(output)
+    # Pages share the reader's stream and object cache, so extract them in order
+    reader = _pypdf().PdfReader(io.BytesIO(data))
+    return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _extract_text(digest, kind, _data):
+    """Extract text from raw upload bytes, cached per SHA256 of the full content"""
+    # PDF files
+    if kind == "pdf":
+        return _extract_pdf_text(_data)
+    # Word documents
+    return _docx2txt().process(io.BytesIO(_data))
 
 def extract_text_from_file(uploaded_file):
-    """Extract text from various file types"""
+    """Extract text from various file types; text uploads come back as raw UTF-8 bytes"""
+    kind = _file_kind(uploaded_file.type)
+    if kind is None:
+        st.error(f"Unsupported file type: {uploaded_file.type}")
+        return None
+    
     try:
-        # Text-based files
-        if uploaded_file.type.startswith('text/') or \
-           uploaded_file.type in ['application/json', 'application/xml']:
-            return uploaded_file.getvalue().decode('utf-8')
-            
-        # PDF files
-        elif uploaded_file.type == 'application/pdf':
-            try:
-                import PyPDF2
-                reader = PyPDF2.PdfReader(uploaded_file)
-                return "\n".join([page.extract_text() for page in reader.pages])
-            except ImportError:
-                st.error("PyPDF2 required for PDF processing. Install with `pip install PyPDF2`")
-                return None
-                
-        # Word documents
-        elif uploaded_file.type in ['application/vnd.openxmlformats-officedocument.wordprocessingml.document', 
-                                   'application/msword']:
-            try:
-                import docx2txt
-                return docx2txt.process(uploaded_file)
-            except ImportError:
-                st.error("docx2txt required for DOCX processing. Install with `pip install docx2txt`")
-                return None
-                
-        else:
-            st.error(f"Unsupported file type: {uploaded_file.type}")
-            return None
-            
+        data = uploaded_file.getvalue()
+        # Text-based files are kept as UTF-8 bytes once validated; anything else
+        # raises UnicodeDecodeError and is reported below
+        if kind == "text":
+            data.decode("utf-8", "strict")
+            return data
+        # The cache is shared by all sessions, so only identical content may share an entry
+        return _extract_text(hashlib.sha256(data).hexdigest(), kind, data)
+    except MissingDependencyError as e:
+        st.error(str(e))
+        return None
     except Exception as e:
         st.error(f"Error processing file: {str(e)}")
         return None
 
+# Must be the first Streamlit command; loading history below can already draw a spinner
+st.set_page_config(
+    page_title="Ollama Chat",
+    layout="centered",  # Changed to centered for better button layout
+    page_icon="🤖"
+)
+
 # ─── Init session_state ──────────────────────────────────────────────────────
+if USER_ID_KEY not in st.session_state:
+    st.session_state[USER_ID_KEY] = str(uuid.uuid4())
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = load_history()
 if "messages" not in st.session_state:
     st.session_state.messages = []
-if "current_idx" not in st.session_state:
-    st.session_state.current_idx = None
-if "to_stream" not in st.session_state:
-    st.session_state.to_stream = None
-if "stop_requested" not in st.session_state:
-    st.session_state.stop_requested = False
+if "history_limit" not in st.session_state:
+    st.session_state.history_limit = HISTORY_PAGE_SIZE
+if "message_limit" not in st.session_state:
+    st.session_state.message_limit = MESSAGE_PAGE_SIZE
+if "current_id" not in st.session_state:
+    st.session_state.current_id = None
+if "streaming" not in st.session_state:
+    st.session_state.streaming = None  # {"model", "chunks"} while a reply streams
+if "warmed_model" not in st.session_state:
+    st.session_state.warmed_model = None
 if SYSTEM_PROMPT_KEY not in st.session_state:
     st.session_state[SYSTEM_PROMPT_KEY] = "You are a helpful AI assistant."
-if "file_text" not in st.session_state:
-    st.session_state.file_text = None
-
-st.set_page_config(
-    page_title="Ollama Chat",
-    layout="centered",  # Changed to centered for better button layout
-    page_icon="🤖"
-)
+if "file_context" not in st.session_state:
+    st.session_state.file_context = None
+if "file_key" not in st.session_state:
+    st.session_state.file_key = None
+    st.session_state.file_upload = None
 
 # Custom CSS for better scrolling and button layout
 st.markdown("""
@@ -158,6 +469,83 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+# ─── Callbacks ───────────────────────────────────────────────────────────────
+def record_reply(content, model):
+    """Append an assistant reply to the current chat and save it"""
+    st.session_state.messages.append({"role": "assistant", "content": content})
+    
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
+    if st.session_state.current_id is None:
+        # New chat; the title is fixed here so later saves never rescan messages
+        first_user = next((m["content"] for m in st.session_state.messages if m["role"] == "user"), "Chat")
+        title = first_user[:30] + "..." if len(first_user) > 30 else first_user
+        st.session_state.current_id = uuid.uuid4().hex
+        st.session_state.chat_history[st.session_state.current_id] = {
+            "name": title,
+            "messages": st.session_state.messages,
+            "timestamp": timestamp,
+            "model": model
+        }
+    else:
+        # Update existing chat
+        st.session_state.chat_history[st.session_state.current_id].update({
+            "messages": st.session_state.messages,
+            "timestamp": timestamp,
+            "model": model
+        })
+    
+    save_chat(
+        st.session_state.chat_history[st.session_state.current_id],
+        st.session_state.current_id
+    )
+
+def finish_interrupted_reply():
+    """Keep the partial reply of a run cut short by Stop or any other interaction"""
+    if st.session_state.streaming is not None:
+        streaming, st.session_state.streaming = st.session_state.streaming, None
+        record_reply("".join(streaming["chunks"]), streaming["model"])
+
+# Button callbacks run before the rerun a click triggers, so the page renders
+# with the new state in one pass instead of needing an extra st.rerun()
+def clear_all_chats():
+    finish_interrupted_reply()
+    st.session_state.chat_history = {}
+    clear_history()
+    st.session_state.messages = []
+    st.session_state.message_limit = MESSAGE_PAGE_SIZE
+    st.session_state.current_id = None
+
+def load_chat(chat_id):
+    finish_interrupted_reply()
+    st.session_state.messages = chat_messages(chat_id).copy()
+    st.session_state.message_limit = MESSAGE_PAGE_SIZE
+    st.session_state.current_id = chat_id
+
+def remove_chat(chat_id):
+    finish_interrupted_reply()
+    del st.session_state.chat_history[chat_id]
+    delete_chat(chat_id)
+    if st.session_state.current_id == chat_id:
+        st.session_state.messages = []
+        st.session_state.message_limit = MESSAGE_PAGE_SIZE
+        st.session_state.current_id = None
+
+def discard_file_upload():
+    # file_key is kept, so a file still in the uploader is not attached again
+    if st.session_state.file_upload is not None:
+        st.session_state.file_upload.delete()
+    st.session_state.file_upload = None
+    st.session_state.file_context = None
+
+def show_older_chats():
+    st.session_state.history_limit += HISTORY_PAGE_SIZE
+
+def show_earlier_messages():
+    st.session_state.message_limit += MESSAGE_PAGE_SIZE
+
+# Any interaction during a stream stops that run; save what had arrived
+finish_interrupted_reply()
+
 # ─── Sidebar ─────────────────────────────────────────────────────────────────
 st.sidebar.title("⚙️ Settings")
 
@@ -173,30 +561,66 @@ uploaded_file = st.sidebar.file_uploader(
 )
 
 if uploaded_file:
-    with st.spinner("Extracting text from file..."):
-        extracted_text = extract_text_from_file(uploaded_file)
-        if extracted_text:
-            st.session_state.file_text = extracted_text
-            st.sidebar.success(f"Extracted {len(extracted_text)} characters")
-            st.sidebar.expander("View extracted text").code(extracted_text[:2000] + ("..." if len(extracted_text) > 2000 else ""))
+    # file_id is new for every upload, even of a different file with the same name and size
+    file_key = uploaded_file.file_id
+    if st.session_state.file_key != file_key:
+        # Extract, truncate and build previews once per upload rather than every rerun
+        with st.spinner("Extracting text from file..."):
+            extracted = extract_text_from_file(uploaded_file)
+        st.session_state.file_key = file_key
+        discard_file_upload()
+        if extracted:
+            if isinstance(extracted, bytes):
+                # Decode only what the previews show; 4 bytes covers any UTF-8 character
+                extracted_chars = utf8_char_count(extracted)
+                preview_text = extracted[:3000 * 4].decode("utf-8", errors="ignore")
+            else:
+                extracted_chars = len(extracted)
+                preview_text = extracted
+            # Keep only a path and stats in session state; the text is read back on send
+            st.session_state.file_upload = FileContext(extracted, extracted_chars)
+            st.session_state.file_text_preview_sidebar = truncate_preview(preview_text, 2000)
+            st.session_state.file_text_preview_main = truncate_preview(preview_text, 3000)
+    
+    st.session_state.file_context = st.session_state.file_upload
+    if st.session_state.file_upload:
+        extracted_chars = st.session_state.file_upload.chars
+        if extracted_chars > MAX_FILE_CONTEXT_CHARS:
+            st.sidebar.success(f"Extracted {extracted_chars} characters (first {MAX_FILE_CONTEXT_CHARS} are used)")
         else:
-            st.session_state.file_text = None
+            st.sidebar.success(f"Extracted {extracted_chars} characters")
+        st.sidebar.expander("View extracted text").code(st.session_state.file_text_preview_sidebar)
+else:
+    st.session_state.file_key = None
+    discard_file_upload()
 
-if st.session_state.file_text:
-    if st.sidebar.button("❌ Clear File Content"):
-        st.session_state.file_text = None
+if st.session_state.file_context:
+    st.sidebar.button("❌ Clear File Content", on_click=discard_file_upload)
 
 # Model selection with refresh
 st.sidebar.subheader("Model Configuration")
+models = get_ollama_models()
 model_col1, model_col2 = st.sidebar.columns([4, 1])
 with model_col1:
-    models = get_ollama_models()
     selected_model = st.selectbox("Select Model", models, index=0 if models else 0)
 with model_col2:
     st.sidebar.write("")  # Vertical spacing
-    if st.sidebar.button("🔄", help="Refresh model list"):
-        models = get_ollama_models()
-        st.rerun()
+    # Clearing in the click callback lets the rerun's single probe above refresh the list
+    st.sidebar.button("🔄", help="Refresh model list", on_click=get_ollama_models.clear)
+
+# Load the model as soon as it is picked so the first message skips the load time
+if selected_model != st.session_state.warmed_model:
+    warm_model(selected_model)
+    st.session_state.warmed_model = selected_model
+
+# Context window
+max_context_msgs = st.sidebar.number_input(
+    "Messages sent as context",
+    min_value=1,
+    value=MAX_CONTEXT_MSGS,
+    help="At most this many recent messages are sent to the model; older ones are dropped "
+         "half this many at a time so the start of the prompt stays the same for several turns"
+)
 
 # System prompt
 st.sidebar.subheader("System Prompt")
@@ -213,45 +637,33 @@ if system_prompt != st.session_state[SYSTEM_PROMPT_KEY]:
 st.sidebar.subheader("Chat Management")
 if st.sidebar.button("🆕 New Chat", use_container_width=True):
     st.session_state.messages = []
-    st.session_state.current_idx = None
-    st.session_state.to_stream = None
-    st.session_state.stop_requested = False
-    st.session_state.file_text = None
+    st.session_state.message_limit = MESSAGE_PAGE_SIZE
+    st.session_state.current_id = None
+    discard_file_upload()
 
 # History management
 st.sidebar.subheader("📜 Chat History")
 if st.session_state.chat_history:
-    if st.sidebar.button("🗑️ Clear All History", use_container_width=True):
-        st.session_state.chat_history = []
-        save_history(st.session_state.chat_history)
-        st.session_state.messages = []
-        st.session_state.current_idx = None
-        st.rerun()
-
-    for rev_i, chat_obj in enumerate(st.session_state.chat_history[::-1]):
-        orig_i = len(st.session_state.chat_history) - 1 - rev_i
-        name = chat_obj.get(
-            "name",
-            f"Chat {orig_i+1} ({len(chat_obj['messages']) // 2} messages)"
-        )
+    st.sidebar.button("🗑️ Clear All History", use_container_width=True, on_click=clear_all_chats)
+
+    n = len(st.session_state.chat_history)
+    shown = islice(reversed(st.session_state.chat_history.items()), st.session_state.history_limit)
+    for rev_i, (chat_id, chat_obj) in enumerate(shown):
+        orig_i = n - 1 - rev_i
+        # Fall back lazily so unnamed chats are the only ones decoded here
+        name = chat_obj.get("name") or f"Chat {orig_i+1} ({len(chat_messages(chat_id)) // 2} messages)"
 
         timestamp = chat_obj.get("timestamp", "")
         
         with st.sidebar.expander(f"{name} {timestamp}"):
-            if st.button("💬 Load", key=f"load_{orig_i}"):
-                st.session_state.messages = chat_obj["messages"].copy()
-                st.session_state.current_idx = orig_i
-                st.session_state.to_stream = None
-                st.session_state.stop_requested = False
-                st.rerun()
-            
-            if st.button("🗑️ Delete", key=f"del_{orig_i}"):
-                st.session_state.chat_history.pop(orig_i)
-                save_history(st.session_state.chat_history)
-                if st.session_state.current_idx == orig_i:
-                    st.session_state.messages = []
-                    st.session_state.current_idx = None
-                st.rerun()
+            st.button("💬 Load", key=f"load_{chat_id}", on_click=load_chat, args=(chat_id,))
+            st.button("🗑️ Delete", key=f"del_{chat_id}", on_click=remove_chat, args=(chat_id,))
+
+    if n > st.session_state.history_limit:
+        st.sidebar.button(
+            f"Show older chats ({n - st.session_state.history_limit} more)",
+            use_container_width=True, on_click=show_older_chats
+        )
 else:
     st.sidebar.info("No chat history yet.")
 
@@ -263,182 +675,88 @@ st.caption(f"Using model: **{selected_model}**")
 chat_container = st.container()
 
 with chat_container:
+    # Only the latest messages are drawn, so long chats render in bounded time;
+    # the full list is still kept and saved
+    hidden = len(st.session_state.messages) - st.session_state.message_limit
+    if hidden > 0:
+        st.button(f"Show earlier messages ({hidden} more)", on_click=show_earlier_messages)
+    
     # Display messages with nicer formatting
-    for msg in st.session_state.messages:
+    for msg in st.session_state.messages[-st.session_state.message_limit:]:
         avatar = "🧑‍💻" if msg["role"] == "user" else "🤖"
         with st.chat_message(msg["role"], avatar=avatar):
-            if msg["role"] == "assistant" and msg.get("formatted", False):
-                st.markdown(msg["content"], unsafe_allow_html=True)
-            else:
-                st.markdown(msg["content"])
+            st.markdown(msg["content"])
 
 # ─── File Context Display ────────────────────────────────────────────────────
-if st.session_state.file_text:
+if st.session_state.file_context:
     with st.expander("📄 Current File Context"):
         st.caption("This text will be included with your next message")
-        st.code(st.session_state.file_text[:3000] + ("..." if len(st.session_state.file_text) > 3000 else ""))
+        st.code(st.session_state.file_text_preview_main)
 
 # ... (keep all your existing imports and code until the streaming section)
 
 # ... (keep all your existing imports and code until the streaming section)
 
 # ─── Input and Streaming ─────────────────────────────────────────────────────
-if st.session_state.to_stream is None:
-    user_input = st.chat_input("Type your message here...")
-    if user_input:
-        # Add file context if available
-        if st.session_state.file_text:
-            user_input = f"File context:\n{st.session_state.file_text}\n\n---\n\n{user_input}"
-            st.session_state.file_text = None  # Clear after use
-        
-        # Add user message to history
-        st.session_state.messages.append({"role": "user", "content": user_input})
-        
-        # Prepare messages with system prompt
-        messages_for_api = [{"role": "system", "content": st.session_state[SYSTEM_PROMPT_KEY]}]
-        messages_for_api.extend(st.session_state.messages.copy())
-        
-        # Queue for streaming
-        st.session_state.to_stream = {
-            "model": selected_model,
-            "messages": messages_for_api
-        }
-        st.session_state.stop_requested = False
-        st.rerun()
-else:
-    # Better stop button layout
+def record_chunks(chunks, sink):
+    """Pass chunks through while keeping a copy of each in sink"""
+    for chunk in chunks:
+        sink.append(chunk)
+        yield chunk
+
+def stream_reply(model, messages):
+    """Stream the assistant reply in this run, then save it"""
+    st.session_state.streaming = {"model": model, "chunks": []}
+    
+    # Follow the reply as it streams; the frame is dropped on the rerun after it
+    components.html(SCROLL_JS, height=0)
+    
+    # Clicking stop reruns the script, which ends this stream; the next run
+    # keeps the partial reply via finish_interrupted_reply()
     stop_col, _ = st.columns([1, 5])
     with stop_col:
-        if st.button("⏹️ Stop Generating", key="stop_button", use_container_width=True):
-            st.session_state.stop_requested = True
-            st.rerun()
+        st.button("⏹️ Stop Generating", key="stop_button", use_container_width=True)
     
-    # Create a container specifically for the streaming message
-    streaming_container = st.container()
+    full_response = ""
+    with st.chat_message("assistant", avatar="🤖"):
+        response_placeholder = st.empty()
+        try:
+            # st.write_stream draws the cursor; deltas arrive in timed batches.
+            # Each delta is recorded as it arrives, so a stop keeps everything
+            # received, including a batch that was never drawn
+            with response_placeholder.container():
+                full_response = st.write_stream(coalesce_deltas(record_chunks(
+                    stream_chat(model, messages),
+                    st.session_state.streaming["chunks"]
+                )))
+        except Exception as e:
+            full_response = f"**Error:** {str(e)}"
+            response_placeholder.markdown(full_response)
     
-    with streaming_container:
-        full_response = ""
-        message_placeholder = st.empty()
-        
-        with message_placeholder.container():
-            with st.chat_message("assistant", avatar="🤖"):
-                response_placeholder = st.empty()
-                
-                # Initial scroll to bottom
-                st.markdown(
-                    """
-                    <script>
-                    function scrollToBottom() {
-                        // Try to find the specific chat container first
-                        const chatContainer = window.parent.document.querySelector('.chat-container');
-                        if (chatContainer) {
-                            chatContainer.scrollTop = chatContainer.scrollHeight;
-                        } else {
-                            // Fallback to document scrolling
-                            window.parent.document.body.scrollTop = window.parent.document.body.scrollHeight;
-                            window.parent.document.documentElement.scrollTop = window.parent.document.documentElement.scrollHeight;
-                        }
-                    }
-                    // Scroll immediately and then every 100ms during streaming
-                    scrollToBottom();
-                    const scrollInterval = setInterval(scrollToBottom, 100);
-                    </script>
-                    """,
-                    unsafe_allow_html=True
-                )
-                
-                try:
-                    for chunk in chat(
-                        model=st.session_state.to_stream["model"],
-                        messages=st.session_state.to_stream["messages"],
-                        stream=True
-                    ):
-                        if st.session_state.stop_requested:
-                            break
-                            
-                        delta = chunk.get("message", {}).get("content", "")
-                        full_response += delta
-                        
-                        # Update with basic formatting during streaming
-                        formatted = render_markdown_with_code(full_response)
-                        response_placeholder.markdown(formatted + "▌", unsafe_allow_html=True)
-                        
-                        # Small delay to prevent UI blocking
-                        time.sleep(0.01)
-                        
-                except Exception as e:
-                    full_response = f"**Error:** {str(e)}"
-                    response_placeholder.markdown(full_response)
-                finally:
-                    # Clear the interval when done
-                    st.markdown(
-                        """
-                        <script>
-                        if (typeof scrollInterval !== 'undefined') {
-                            clearInterval(scrollInterval);
-                        }
-                        scrollToBottom(); // One final scroll
-                        </script>
-                        """,
-                        unsafe_allow_html=True
-                    )
-            
-            # Final rendering with proper formatting
-            formatted_response = render_markdown_with_code(full_response)
-            response_placeholder.markdown(formatted_response, unsafe_allow_html=True)
-            
-            # Add assistant message to history with formatting flag
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": formatted_response,
-                "formatted": True
-            })
-            
-            # Save to history
-            if st.session_state.current_idx is None:
-                # New chat
-                first_user = next((m["content"] for m in st.session_state.messages if m["role"] == "user"), "Chat")
-                title = first_user[:30] + "..." if len(first_user) > 30 else first_user
-                st.session_state.chat_history.append({
-                    "name": title,
-                    "messages": st.session_state.messages.copy(),
-                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M"),
-                    "model": selected_model
-                })
-                st.session_state.current_idx = len(st.session_state.chat_history) - 1
-            else:
-                # Update existing chat
-                st.session_state.chat_history[st.session_state.current_idx] = {
-                    **st.session_state.chat_history[st.session_state.current_idx],
-                    "messages": st.session_state.messages.copy(),
-                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M"),
-                    "model": selected_model
-                }
-            
-            save_history(st.session_state.chat_history)
-            
-            # Reset streaming state
-            st.session_state.to_stream = None
-            st.session_state.stop_requested = False
-            st.rerun()
-
-# Final auto-scroll to ensure we're at bottom
-st.markdown(
-    """
-    <script>
-    // Simple immediate scroll to bottom
-    function scrollNow() {
-        const chatContainer = window.parent.document.querySelector('.chat-container');
-        if (chatContainer) {
-            chatContainer.scrollTop = chatContainer.scrollHeight;
-        } else {
-            window.scrollTo(0, document.body.scrollHeight);
-        }
-    }
-    // Try scrolling immediately and again after a short delay
-    scrollNow();
-    setTimeout(scrollNow, 300);
-    </script>
-    """, 
-    unsafe_allow_html=True
-)
\ No newline at end of file
+    st.session_state.streaming = None
+    # Store the raw reply; Streamlit's markdown renders code fences natively
+    record_reply(full_response, model)
+
+user_input = st.chat_input("Type your message here...")
+if user_input:
+    # Add file context if available
+    if st.session_state.file_context:
+        file_text = "".join(iter_file_context(st.session_state.file_context.path, MAX_FILE_CONTEXT_CHARS))
+        user_input = f"File context:\n{file_text}\n\n---\n\n{user_input}"
+        discard_file_upload()  # Clear after use
+    
+    # Add user message to history and show it without waiting for a rerun
+    st.session_state.messages.append({"role": "user", "content": user_input})
+    with chat_container:
+        with st.chat_message("user", avatar="🧑‍💻"):
+            st.markdown(user_input)
+    
+    # Prepare messages with system prompt
+    messages_for_api = [
+        {"role": "system", "content": st.session_state[SYSTEM_PROMPT_KEY]},
+        *context_window(st.session_state.messages, max_context_msgs)
+    ]
+    
+    stream_reply(selected_model, messages_for_api)
+    # Rerun once so the sidebar lists the updated chat
+    st.rerun()
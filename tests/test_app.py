@@ -0,0 +1,14 @@
+from pathlib import Path
+
+from streamlit.testing.v1 import AppTest
+
+APP = str(Path(__file__).resolve().parent.parent / "app.py")
+
+
+def test_first_run_on_empty_directory(tmp_path, monkeypatch):
+    """A new session starts cleanly with no history database and no Ollama server"""
+    monkeypatch.chdir(tmp_path)
+    at = AppTest.from_file(APP, default_timeout=30).run()
+    assert not at.exception
+    assert (tmp_path / "history.db").exists()
+    assert at.title[0].value == "💬 Chat with Ollama"
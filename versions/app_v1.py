@@ -1,6 +1,6 @@
 import streamlit as st
 from ollama import chat
-import subprocess, json, os
+import subprocess, json, os, hashlib
 
 # ─── Constants & Helpers ──────────────────────────────────────────────────────
 HISTORY_FILE = "chat_history.json"
@@ -12,6 +12,8 @@ def load_history():
 def save_history(h):
     with open(HISTORY_FILE, "w", encoding="utf-8") as f:
         json.dump(h, f, indent=2)
+def chat_hash(messages):
+    return hashlib.blake2b(json.dumps(messages).encode("utf-8"), digest_size=16).hexdigest()
 def get_ollama_models():
     try:
         out = subprocess.run(["ollama","list"], capture_output=True, text=True, check=True).stdout
@@ -23,6 +25,8 @@ def get_ollama_models():
 # ─── Init session_state ──────────────────────────────────────────────────────
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = load_history()
+    for c in st.session_state.chat_history:
+        c.setdefault("hash", chat_hash(c["messages"]))  # backfill chats saved before hashing
 if "messages" not in st.session_state:
     st.session_state.messages = []
 if "current_idx" not in st.session_state:
@@ -123,16 +127,20 @@ else:
     # save or update history
     first_user = next((m["content"] for m in st.session_state.messages if m["role"]=="user"), "Chat")
     title = first_user.split("\n")[0][:40]
+    digest = chat_hash(st.session_state.messages)
     if st.session_state.current_idx is None:
-        existing = [c["messages"] for c in st.session_state.chat_history]
-        if st.session_state.messages not in existing:
+        # compare 16-byte digests instead of deep-comparing every stored chat
+        existing = {c.get("hash") for c in st.session_state.chat_history}
+        if digest not in existing:
             st.session_state.chat_history.append({
                 "name": title,
-                "messages": st.session_state.messages.copy()
+                "messages": st.session_state.messages.copy(),
+                "hash": digest
             })
             st.session_state.current_idx = len(st.session_state.chat_history)-1
     else:
         st.session_state.chat_history[st.session_state.current_idx]["messages"] = st.session_state.messages.copy()
+        st.session_state.chat_history[st.session_state.current_idx]["hash"] = digest
 
     save_history(st.session_state.chat_history)
 